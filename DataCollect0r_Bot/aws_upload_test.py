@@ -1,19 +1,44 @@
 import requests
 import os
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from requests.adapters import HTTPAdapter
+from requests_toolbelt import MultipartEncoder
+from urllib3.util import Retry
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Number of files uploaded at the same time by upload_multiple_files
+MAX_UPLOAD_WORKERS = 8
+
+# Request bodies are sent in 1 MiB blocks instead of urllib3's 16 KiB default
+UPLOAD_BLOCK_SIZE = 1 << 20
+
+class LargeBlockHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter whose connections send streamed request bodies in large blocks"""
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["blocksize"] = UPLOAD_BLOCK_SIZE
+        super().init_poolmanager(*args, **kwargs)
+
 class PixoformUploader:
     def __init__(self, base_url="https://pixoform.com/api/v1/main"):
         self.base_url = base_url
         self.upload_single_url = f"{base_url}/upload-file"
-        self.upload_multiple_url = f"{base_url}/upload-files"
         self.delete_url = f"{base_url}/delete-files"
 
+        # Shared session so every request reuses pooled keep-alive connections
+        self.session = requests.Session()
+        adapter = LargeBlockHTTPAdapter(
+            pool_connections=16,
+            pool_maxsize=16,
+            max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[502, 503, 504])
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
     def upload_single_file(self, file_path):
         """Upload a single file"""
         try:
@@ -24,9 +49,14 @@ class PixoformUploader:
 
             logger.info(f"Uploading {file_path.name}...")
             
+            # Stream the multipart body from disk instead of building it in memory
             with open(file_path, 'rb') as f:
-                files = {'file': (file_path.name, f, 'video/mp4')}
-                response = requests.post(self.upload_single_url, files=files)
+                encoder = MultipartEncoder(fields={'file': (file_path.name, f, 'video/mp4')})
+                response = self.session.post(
+                    self.upload_single_url,
+                    data=encoder,
+                    headers={'Content-Type': encoder.content_type}
+                )
             
             response.raise_for_status()
             result = response.json()
@@ -46,56 +76,33 @@ class PixoformUploader:
             return None
 
     def upload_multiple_files(self, file_paths):
-        """Upload multiple files"""
-        try:
-            files = []
-            file_handles = []
-            
-            for file_path in file_paths:
-                file_path = Path(file_path)
-                if not file_path.exists():
-                    logger.warning(f"File not found, skipping: {file_path}")
-                    continue
-                
-                f = open(file_path, 'rb')
-                file_handles.append(f)
-                files.append(('files[]', (file_path.name, f, 'video/mp4')))
-            
-            if not files:
-                logger.error("No valid files to upload")
-                return None
-            
-            logger.info(f"Uploading {len(files)} files...")
-            
-            response = requests.post(self.upload_multiple_url, files=files)
-            
-            # Close all file handles
-            for f in file_handles:
-                f.close()
-            
-            response.raise_for_status()
-            result = response.json()
-            
-            logger.info("Multiple upload successful")
-            logger.info(f"Response: {result}")
-            
-            return result
+        """Upload multiple files in parallel, one request per file"""
+        valid_paths = []
+        
+        for file_path in file_paths:
+            file_path = Path(file_path)
+            if not file_path.exists():
+                logger.warning(f"File not found, skipping: {file_path}")
+                continue
             
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Multiple upload failed: {e}")
-            if hasattr(e, 'response') and e.response:
-                logger.error(f"Response: {e.response.text}")
+            valid_paths.append(file_path)
+        
+        if not valid_paths:
+            logger.error("No valid files to upload")
             return None
-        except Exception as e:
-            logger.error(f"Error uploading files: {e}")
+        
+        logger.info(f"Uploading {len(valid_paths)} files...")
+        
+        with ThreadPoolExecutor(max_workers=MAX_UPLOAD_WORKERS) as executor:
+            results = list(executor.map(self.upload_single_file, valid_paths))
+        
+        if not any(results):
+            logger.error(f"All {len(results)} single-file uploads failed")
             return None
-        finally:
-            # Ensure all files are closed
-            for f in file_handles:
-                try:
-                    f.close()
-                except:
-                    pass
+        
+        logger.info(f"Parallel upload finished: {sum(1 for r in results if r)}/{len(results)} single-file uploads succeeded")
+        
+        return results
 
     def delete_files(self, file_urls):
         """Delete files from server"""
@@ -103,7 +110,7 @@ class PixoformUploader:
             logger.info(f"Deleting {len(file_urls)} files...")
             
             data = {"file_urls": file_urls}
-            response = requests.post(self.delete_url, json=data)
+            response = self.session.post(self.delete_url, json=data)
             
             response.raise_for_status()
             result = response.json()
@@ -141,13 +148,13 @@ def test_upload():
             if result:
                 logger.info("✓ Single file upload test passed")
                 
-                # If we have multiple files, test multiple upload
+                # If we have multiple files, test parallel single-file uploads
                 if len(video_files) > 1:
                     multiple_files = video_files[:3]  # Upload max 3 files for testing
                     result_multiple = uploader.upload_multiple_files(multiple_files)
                     
                     if result_multiple:
-                        logger.info("✓ Multiple file upload test passed")
+                        logger.info(f"✓ Parallel upload test passed ({len(result_multiple)} single-file uploads)")
                     
                 # Test delete (if we got URLs back)
                 if isinstance(result, dict) and 'url' in result:
@@ -1,20 +1,75 @@
 import os
 import sqlite3
 import logging
+import threading
+from collections import namedtuple
 
 logger = logging.getLogger(__name__)
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_FILE_PATH = os.path.join(BASE_DIR, "dataset.db")
 
+# Column order of the "dataset" table, used to build INSERT parameters
+DATASET_FIELDS = ("telegram_id", "username", "category", "url", "date", "description", "upload_status")
+
+# Rows yielded by get_payload_data()
+PayloadRow = namedtuple("PayloadRow", "rowid telegram_id username url category date upload_status description")
+
+# Built once so every save reuses the same statement from sqlite3's cache
+_INSERT_SQL = """
+INSERT INTO dataset VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (telegram_id, url, category) DO UPDATE SET
+                    username = excluded.username,
+                    date = excluded.date,
+                    upload_status = excluded.upload_status,
+                    description = excluded.description
+"""
+
+# Shared connection, opened lazily by _get_conn(). sqlite3 connections are not
+# safe for concurrent writes, so every write transaction holds _LOCK.
+_CONN = None
+_LOCK = threading.Lock()
+
+# Set once init_db() has created the schema in this process
+_initialized = False
+
+def _index_exists(cur, name):
+    """Return True if an index called `name` exists in the database"""
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?", (name,))
+    return cur.fetchone() is not None
+
+def _get_conn():
+    """Return the shared database connection, opening it on first use"""
+    global _CONN
+    with _LOCK:
+        if _CONN is None:
+            conn = sqlite3.connect(DB_FILE_PATH, check_same_thread=False)
+            cur = conn.cursor()
+
+            # WAL with synchronous=NORMAL avoids an fsync on every commit; the rest
+            # keeps temp tables and up to 64 MiB of pages in memory and mmaps reads
+            cur.execute("PRAGMA journal_mode=WAL")
+            cur.execute("PRAGMA synchronous=NORMAL")
+            cur.execute("PRAGMA temp_store=MEMORY")
+            cur.execute("PRAGMA cache_size=-65536")
+            cur.execute("PRAGMA mmap_size=268435456")
+
+            _CONN = conn
+        return _CONN
+
 def init_db():
     """Initialize the database and create tables if they don't exist"""
+    global _initialized
+    if _initialized:
+        return
+    
     try:
-        conn = sqlite3.connect(DB_FILE_PATH, check_same_thread=False)
-        cur = conn.cursor()
-        
-        # Create the "dataset" table
-        cur.execute("""
+        conn = _get_conn()
+        with _LOCK, conn:
+            cur = conn.cursor()
+            
+            # Create the "dataset" table
+            cur.execute("""
 CREATE TABLE IF NOT EXISTS dataset (
                  telegram_id INT,
                  username TEXT,
@@ -26,9 +81,9 @@ CREATE TABLE IF NOT EXISTS dataset (
                  UNIQUE (telegram_id, url, category)
                  )
 """)
-        
-        # Create the "dataset_backup" table
-        cur.execute("""
+            
+            # Create the "dataset_backup" table
+            cur.execute("""
 CREATE TABLE IF NOT EXISTS dataset_backup (
                  telegram_id INT,
                  username TEXT,
@@ -40,9 +95,9 @@ CREATE TABLE IF NOT EXISTS dataset_backup (
                  download_status TEXT DEFAULT 'not_downloaded'
                  )
 """)
-        
-        # Create the video analysis table
-        cur.execute("""
+            
+            # Create the video analysis table
+            cur.execute("""
 CREATE TABLE IF NOT EXISTS video_analysis (
                  id INTEGER PRIMARY KEY AUTOINCREMENT,
                  backup_rowid INTEGER,
@@ -53,9 +108,42 @@ CREATE TABLE IF NOT EXISTS video_analysis (
                  FOREIGN KEY (backup_rowid) REFERENCES dataset_backup (rowid)
                  )
 """)
+            
+            # Create the processing metadata table
+            cur.execute("""
+CREATE TABLE IF NOT EXISTS processing_metadata (
+                 id INTEGER PRIMARY KEY AUTOINCREMENT,
+                 backup_rowid INTEGER,
+                 metadata_json TEXT,
+                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                 updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                 )
+""")
+            
+            # One metadata row per backup row. Older databases may hold duplicates
+            # left by INSERT OR REPLACE, so keep only the newest before indexing;
+            # once the index exists there can be no duplicates left to remove.
+            if not _index_exists(cur, "idx_metadata_backup_rowid"):
+                cur.execute("""
+DELETE FROM processing_metadata WHERE id NOT IN (
+                 SELECT MAX(id) FROM processing_metadata GROUP BY backup_rowid
+                 )
+""")
+                cur.execute("""
+CREATE UNIQUE INDEX idx_metadata_backup_rowid ON processing_metadata (backup_rowid)
+""")
+            
+            # Partial index covering the pending-download queue. Lookups by
+            # telegram_id on "dataset" already use its UNIQUE index.
+            if not _index_exists(cur, "idx_backup_dlstatus"):
+                cur.execute("""
+CREATE INDEX idx_backup_dlstatus ON dataset_backup (download_status)
+                 WHERE download_status = 'not_downloaded'
+""")
+                # Gather planner statistics once, when the index is first created
+                cur.execute("ANALYZE")
         
-        conn.commit()
-        conn.close()
+        _initialized = True
         logger.info("Database initialized successfully")
         
     except Exception as e:
@@ -64,37 +152,26 @@ CREATE TABLE IF NOT EXISTS video_analysis (
 
 def save_data_to_db(data):
     """Save data to the database with conflict resolution"""
+    save_many([data])
+
+def save_many(rows):
+    """Save several rows to the database in a single transaction"""
     try:
         # Validate required fields
         required_fields = ['telegram_id', 'username', 'category', 'url', 'date']
-        for field in required_fields:
-            if field not in data or data[field] is None:
-                raise ValueError(f"Missing required field: {field}")
+        for data in rows:
+            for field in required_fields:
+                if field not in data or data[field] is None:
+                    raise ValueError(f"Missing required field: {field}")
         
-        conn = sqlite3.connect(DB_FILE_PATH, check_same_thread=False)
-        cur = conn.cursor()
-        
-        cur.execute("""
-INSERT INTO dataset VALUES (?, ?, ?, ?, ?, ?, ?)
-                    ON CONFLICT (telegram_id, url, category) DO UPDATE SET
-                    username = excluded.username,
-                    date = excluded.date,
-                    upload_status = excluded.upload_status,
-                    description = excluded.description
-""", (
-        data.get("telegram_id"),
-        data.get("username"),
-        data.get("category"),
-        data.get("url"),
-        data.get("date"),
-        data.get("description"),
-        data.get("upload_status")
-    )) 
-
-        conn.commit()
-        conn.close()
+        conn = _get_conn()
+        with _LOCK, conn:
+            cur = conn.cursor()
+            
+            cur.executemany(_INSERT_SQL, [tuple(data.get(field) for field in DATASET_FIELDS) for data in rows])
         
-        logger.info(f"Data saved for user {data.get('telegram_id')}: {data.get('url')} - {data.get('category')}")
+        for data in rows:
+            logger.info(f"Data saved for user {data.get('telegram_id')}: {data.get('url')} - {data.get('category')}")
         
     except Exception as e:
         logger.error(f"Failed to save data to database: {e}")
@@ -103,13 +180,12 @@ INSERT INTO dataset VALUES (?, ?, ?, ?, ?, ?, ?)
 def get_user_data(telegram_id):
     """Get all data for a specific user (optional utility function)"""
     try:
-        conn = sqlite3.connect(DB_FILE_PATH, check_same_thread=False)
+        conn = _get_conn()
         cur = conn.cursor()
         
         cur.execute("SELECT * FROM dataset WHERE telegram_id = ?", (telegram_id,))
         results = cur.fetchall()
         
-        conn.close()
         return results
         
     except Exception as e:
@@ -119,71 +195,85 @@ def get_user_data(telegram_id):
 def get_all_data():
     """Get all data from database (optional utility function)"""
     try:
-        conn = sqlite3.connect(DB_FILE_PATH, check_same_thread=False)
+        conn = _get_conn()
         cur = conn.cursor()
         
         cur.execute("SELECT * FROM dataset")
         results = cur.fetchall()
         
-        conn.close()
         return results
         
     except Exception as e:
         logger.error(f"Failed to retrieve all data: {e}")
         return []
     
-def get_payload_data():
-    try: 
-        conn = sqlite3.connect(DB_FILE_PATH, check_same_thread=False)
-        cur = conn.cursor()
+def get_payload_data(chunk_size=500):
+    """Yield dataset rows for upload as PayloadRow tuples, reading chunk_size rows at a time"""
+    last_rowid = 0
+    while True:
+        try: 
+            conn = _get_conn()
+            cur = conn.cursor()
 
-        cur.execute("SELECT rowid, telegram_id, username, url, category, date, upload_status, description FROM dataset")
-        rows = cur.fetchall()
+            # Page by rowid rather than holding one cursor open, since uploaded
+            # rows are deleted from dataset while the caller is still iterating
+            cur.execute(
+                """
+                SELECT rowid, telegram_id, username, url, category, date, upload_status, description
+                FROM dataset WHERE rowid > ? AND upload_status IS NOT 'uploaded' ORDER BY rowid LIMIT ?
+                """, (last_rowid, chunk_size)
+            )
+            rows = cur.fetchall()
 
-        conn.close()
-        return rows
+        except Exception as e:
+            logger.error(f"Failed to retrieve payload data: {e}")
+            return
 
-    except Exception as e:
-        logger.error(f"Failed to retrieve payload data: {e}")
-        return []
+        if not rows:
+            return
+
+        yield from map(PayloadRow._make, rows)
+        last_rowid = rows[-1][0]
     
 def change_upload_status(rowid, telegram_id, username, url, category, date, description, upload_status):
-    upload_status = "uploaded"
-    try:
-        conn = sqlite3.connect(DB_FILE_PATH, check_same_thread=False)
-        cur = conn.cursor()
-
-        cur.execute("UPDATE dataset SET upload_status = ? WHERE rowid = ?", (upload_status, rowid))
-        conn.commit()
+    change_upload_status_many([(rowid, category)])
 
-        cur.execute(
-            """
-            INSERT INTO dataset_backup (telegram_id, username, category, url, date, description, upload_status) 
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-            """, (telegram_id, username, category, url, date, description, upload_status)
-        )
-        
-        # Delete from original
-        cur.execute("DELETE FROM dataset WHERE rowid = ?", (rowid,))
+def change_upload_status_many(rows):
+    """Move uploaded rows, given as (rowid, category) pairs, from dataset to dataset_backup"""
+    try:
+        conn = _get_conn()
+        # Copy and delete every row in a single transaction; the category is
+        # passed in because callers store the normalized value, not the raw one
+        with _LOCK, conn:
+            cur = conn.cursor()
 
-        conn.commit()
-        conn.close()
+            cur.executemany(
+                """
+                INSERT INTO dataset_backup (telegram_id, username, category, url, date, description, upload_status)
+                SELECT telegram_id, username, ?, url, date, description, 'uploaded' FROM dataset WHERE rowid = ?
+                """, [(category, rowid) for rowid, category in rows]
+            )
+            
+            # Delete from original
+            cur.executemany("DELETE FROM dataset WHERE rowid = ?", [(rowid,) for rowid, _ in rows])
     
     except Exception as e:
         logger.error(f"Failed to update 'upload_status' column: {e}")
         return []
 
-def get_download_url_data():
-    """Fetch distinct URLs from dataset_backup that are not downloaded yet"""
+def get_download_url_data(limit=None):
+    """Fetch URLs from dataset_backup that are not downloaded yet, at most `limit` of them"""
     try:
-        conn = sqlite3.connect(DB_FILE_PATH, check_same_thread=False)
+        conn = _get_conn()
         cur = conn.cursor()
         
-        # Query all URLs with status "not_downloaded"
-        cur.execute("SELECT DISTINCT url, rowid FROM dataset_backup WHERE download_status = 'not_downloaded'")
+        # Query URLs with status "not_downloaded" (a negative LIMIT means no limit)
+        cur.execute(
+            "SELECT url, rowid FROM dataset_backup WHERE download_status = 'not_downloaded' LIMIT ?",
+            (-1 if limit is None else limit,)
+        )
         rows = cur.fetchall()
         
-        conn.close()
         return rows  # list of (url, rowid)
     
     except Exception as e:
@@ -193,31 +283,67 @@ def get_download_url_data():
 def change_download_status(rowid, status="downloaded"):
     """Change the download_status of a specific row in dataset_backup"""
     try:
-        conn = sqlite3.connect(DB_FILE_PATH, check_same_thread=False)
-        cur = conn.cursor()
+        conn = _get_conn()
+        with _LOCK, conn:
+            cur = conn.cursor()
+            
+            cur.execute(
+                "UPDATE dataset_backup SET download_status = ? WHERE rowid = ?",
+                (status, rowid)
+            )
         
-        cur.execute(
-            "UPDATE dataset_backup SET download_status = ? WHERE rowid = ?",
-            (status, rowid)
-        )
-        
-        conn.commit()
-        conn.close()
         logger.info(f"Row {rowid} updated to status '{status}'")
         
     except Exception as e:
         logger.error(f"Error updating download status for rowid {rowid}: {e}")
 
+def save_metadata_to_db(backup_rowid, metadata_json):
+    """Insert or update the processing metadata of a dataset_backup row"""
+    try:
+        conn = _get_conn()
+        with _LOCK, conn:
+            cur = conn.cursor()
+            
+            cur.execute("""
+                INSERT INTO processing_metadata (backup_rowid, metadata_json)
+                VALUES (?, ?)
+                ON CONFLICT (backup_rowid) DO UPDATE SET
+                metadata_json = excluded.metadata_json,
+                updated_at = CURRENT_TIMESTAMP
+            """, (backup_rowid, metadata_json))
+        
+        logger.info(f"Metadata saved for rowid {backup_rowid}")
+        
+    except Exception as e:
+        logger.error(f"Failed to save metadata for rowid {backup_rowid}: {e}")
+
+def get_metadata_download_url(backup_rowid):
+    """Get the (download_url, dataset_id) stored in a row's processing metadata"""
+    try:
+        conn = _get_conn()
+        cur = conn.cursor()
+        
+        cur.execute("""
+            SELECT json_extract(metadata_json, '$.download_url'), json_extract(metadata_json, '$.dataset_id')
+            FROM processing_metadata WHERE backup_rowid = ?
+        """, (backup_rowid,))
+        result = cur.fetchone()
+        
+        return result if result else (None, None)
+    
+    except Exception as e:
+        logger.error(f"Failed to retrieve metadata for rowid {backup_rowid}: {e}")
+        return None, None
+
 def get_processed_videos():
     """Get videos that have been processed but may need analysis"""
     try:
-        conn = sqlite3.connect(DB_FILE_PATH, check_same_thread=False)
+        conn = _get_conn()
         cur = conn.cursor()
         
         cur.execute("SELECT rowid, url FROM dataset_backup WHERE download_status = 'processed'")
         rows = cur.fetchall()
         
-        conn.close()
         return rows
     
     except Exception as e:
@@ -227,7 +353,7 @@ def get_processed_videos():
 def get_video_analysis(backup_rowid=None, url=None):
     """Get video analysis data"""
     try:
-        conn = sqlite3.connect(DB_FILE_PATH, check_same_thread=False)
+        conn = _get_conn()
         cur = conn.cursor()
         
         if backup_rowid:
@@ -238,7 +364,6 @@ def get_video_analysis(backup_rowid=None, url=None):
             cur.execute("SELECT * FROM video_analysis ORDER BY created_at DESC")
         
         results = cur.fetchall()
-        conn.close()
         return results
         
     except Exception as e:
@@ -248,7 +373,7 @@ def get_video_analysis(backup_rowid=None, url=None):
 def get_videos_with_analysis():
     """Get all videos with their analysis data joined"""
     try:
-        conn = sqlite3.connect(DB_FILE_PATH, check_same_thread=False)
+        conn = _get_conn()
         cur = conn.cursor()
         
         cur.execute("""
@@ -270,7 +395,6 @@ def get_videos_with_analysis():
         """)
         
         results = cur.fetchall()
-        conn.close()
         return results
         
     except Exception as e:
@@ -280,7 +404,7 @@ def get_videos_with_analysis():
 def search_video_analysis(search_term):
     """Search through video analysis content"""
     try:
-        conn = sqlite3.connect(DB_FILE_PATH, check_same_thread=False)
+        conn = _get_conn()
         cur = conn.cursor()
         
         cur.execute("""
@@ -298,7 +422,6 @@ def search_video_analysis(search_term):
         """, (f"%{search_term}%",))
         
         results = cur.fetchall()
-        conn.close()
         return results
         
     except Exception as e:
@@ -1,14 +1,20 @@
 import os
-import sqlite3
 import requests
 import logging
 import time
 import json
+import threading
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from urllib.parse import urlparse
 from dotenv import load_dotenv
 from apify_client import ApifyClient
-from database import DB_FILE_PATH, get_download_url_data, change_download_status
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+from database import (init_db, get_download_url_data, change_download_status,
+                      save_metadata_to_db, get_metadata_download_url)
 
 # Load environment variables
 load_dotenv()
@@ -20,10 +26,66 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Read downloads in 1 MiB chunks; videos are several MB, so 8 KiB chunks
+# meant hundreds of Python-level iterations per file
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+# Videos at least this large are fetched as RANGE_DOWNLOAD_PARTS parallel
+# Range requests when the server supports them
+RANGE_DOWNLOAD_THRESHOLD = 16 << 20
+RANGE_DOWNLOAD_PARTS = 4
+
+# Dataset item keys that may hold the video's download URL, in order of preference
+DOWNLOAD_URL_FIELDS = ("downloadURL", "downloadUrl", "url")
+
+def extract_download_url(video_data):
+    """Return the first non-empty download URL field of an Apify dataset item"""
+    return next((value for field in DOWNLOAD_URL_FIELDS if (value := video_data.get(field))), None)
+
+# Apify actor runs allowed per minute across all download workers
+APIFY_CALLS_PER_MINUTE = 8
+
+class TokenBucket:
+    """Thread-safe token bucket allowing `rate` calls per `period` seconds"""
+    def __init__(self, rate, period):
+        self.capacity = rate
+        self.tokens = rate
+        self.fill_rate = rate / period
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available, then take it"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+                self.updated = now
+                
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                
+                wait = (1 - self.tokens) / self.fill_rate
+            
+            time.sleep(wait)
+
 class InstagramDownloader:
     def __init__(self, apify_token, actor_id="9JaThuZFzYiFtPXpc"):
         self.client = ApifyClient(apify_token)
         self.actor_id = actor_id
+        self.actor = self.client.actor(actor_id)
+        self.apify_limiter = TokenBucket(APIFY_CALLS_PER_MINUTE, 60)
+        
+        # Shared session so downloads from the same CDN host reuse connections
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=32,
+            pool_maxsize=32,
+            max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[502, 503, 504])
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
         
         # Create downloads directory if it doesn't exist
         self.download_dir = Path("downloads")
@@ -42,8 +104,9 @@ class InstagramDownloader:
                 "concurrency": 5
             }
 
-            # Run the actor
-            run = self.client.actor(self.actor_id).call(run_input=run_input)
+            # Run the actor once the rate limit allows it
+            self.apify_limiter.acquire()
+            run = self.actor.call(run_input=run_input)
             
             # Check if run was successful
             if run and run.get("status") == "SUCCEEDED":
@@ -53,22 +116,26 @@ class InstagramDownloader:
                 run_id = run.get("id")
                 dataset_id = run.get("defaultDatasetId")
                 
-                # Try to get results from dataset
-                results = []
+                # Try to get the first result from the dataset; only one is used
+                video_data = None
+                results_count = 0
                 try:
-                    for item in self.client.dataset(dataset_id).iterate_items():
-                        results.append(item)
+                    video_data, results_count = self.get_first_dataset_item(dataset_id)
                 except Exception as e:
-                    logger.warning(f"Could not iterate dataset items: {e}")
+                    logger.warning(f"Could not read dataset items: {e}")
+                
+                download_url = extract_download_url(video_data) if video_data else None
                 
-                # Save run metadata for later use
+                # Save run metadata for later use; the download URL is stored so
+                # get_apify_download_urls doesn't have to query Apify again
                 metadata = {
                     "run_id": run_id,
                     "dataset_id": dataset_id,
                     "url": url,
                     "rowid": rowid,
-                    "results_count": len(results),
-                    "has_direct_download": bool(results),
+                    "results_count": results_count,
+                    "has_direct_download": results_count > 0,
+                    "download_url": download_url,
                     "run_status": run.get("status"),
                     "created_at": time.time()
                 }
@@ -76,19 +143,13 @@ class InstagramDownloader:
                 # Save metadata to file for webhook or manual processing
                 self.save_processing_metadata(rowid, metadata)
                 
-                # If we have direct download URLs, try to download
-                if results:
-                    video_data = results[0]
-                    download_url = (video_data.get("downloadURL") or 
-                                  video_data.get("downloadUrl") or 
-                                  video_data.get("url"))
-                    
-                    if download_url:
-                        logger.info(f"Direct download URL found: {download_url}")
-                        filename = self.download_video_file(download_url, rowid, url)
-                        if filename:
-                            metadata["local_file"] = filename
-                            self.save_processing_metadata(rowid, metadata)
+                # If we have a direct download URL, try to download
+                if download_url:
+                    logger.info(f"Direct download URL found: {download_url}")
+                    filename = self.download_video_file(download_url, rowid, url)
+                    if filename:
+                        metadata["local_file"] = filename
+                        self.save_processing_metadata(rowid, metadata)
                 
                 # Mark as processed (videos are available in Apify panel even without direct URLs)
                 change_download_status(rowid, "processed")
@@ -105,86 +166,133 @@ class InstagramDownloader:
             change_download_status(rowid, "failed")
             return None
 
+    def get_first_dataset_item(self, dataset_id):
+        """Return the first item of an Apify dataset, limited to its URL fields, and the item count"""
+        page = self.client.dataset(dataset_id).list_items(limit=1, fields=list(DOWNLOAD_URL_FIELDS))
+        return (page.items[0] if page.items else None), page.total
+
     def download_video_file(self, download_url, rowid, original_url):
         """Download video file from direct URL"""
+        filepath = None
         try:
             logger.info(f"Downloading video from {download_url}")
-            response = requests.get(download_url, stream=True, timeout=300)
-            response.raise_for_status()
 
-            timestamp = int(time.time())
-            filename = f"instagram_video_{timestamp}_{rowid}.mp4"
-            filepath = self.download_dir / filename
+            # mkstemp gives every download its own file, even for parallel runs
+            fd, filepath = tempfile.mkstemp(prefix=f"instagram_video_{rowid}_", suffix=".mp4",
+                                            dir=self.download_dir)
             
-            with open(filepath, "wb") as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
+            with os.fdopen(fd, "wb", buffering=DOWNLOAD_CHUNK_SIZE) as f:
+                response = self.session.get(download_url, stream=True, timeout=300)
+                response.raise_for_status()
+                
+                # The size comes from this GET's headers, so small files (the common
+                # case) need no extra request; large ones switch to parallel ranges
+                size = self.get_range_download_size(response.headers)
+                if size:
+                    response.close()
+                    if self.download_video_ranges(download_url, f.fileno(), size):
+                        logger.info(f"Video downloaded in {RANGE_DOWNLOAD_PARTS} parts: {filepath}")
+                        return filepath
+                    
+                    response = self.session.get(download_url, stream=True, timeout=300)
+                    response.raise_for_status()
+                
+                with response:
+                    # Reserve the whole file up front when the size is known
+                    content_length = response.headers.get("content-length")
+                    if content_length and hasattr(os, "posix_fallocate"):
+                        os.posix_fallocate(f.fileno(), 0, int(content_length))
+                    
+                    # Copy straight from the raw response instead of building a bytes
+                    # object per chunk through iter_content
+                    response.raw.decode_content = True
+                    shutil.copyfileobj(response.raw, f, length=DOWNLOAD_CHUNK_SIZE)
+                
+                # Drop any reserved space that was not written to
+                f.truncate(f.tell())
 
             logger.info(f"Video downloaded: {filepath}")
-            return str(filepath)
+            return filepath
             
         except Exception as e:
             logger.error(f"Failed to download video file: {e}")
+            # Don't leave a partial video behind
+            if filepath:
+                Path(filepath).unlink(missing_ok=True)
             return None
 
-    def save_processing_metadata(self, rowid, metadata):
-        """Save processing metadata to database"""
+    def get_range_download_size(self, headers):
+        """Return the file size from response headers if it is large enough to download in parallel ranges"""
+        if not hasattr(os, "pwrite"):
+            return None
+        
+        # Ranges of an encoded body don't map onto offsets in the decoded file
+        if headers.get("accept-ranges") != "bytes" or "content-encoding" in headers:
+            return None
+        
         try:
-            conn = sqlite3.connect(DB_FILE_PATH, check_same_thread=False)
-            cur = conn.cursor()
-            
-            # Create metadata table if it doesn't exist
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS processing_metadata (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    backup_rowid INTEGER,
-                    metadata_json TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            
-            # Insert or update metadata
-            cur.execute("""
-                INSERT OR REPLACE INTO processing_metadata (backup_rowid, metadata_json, updated_at)
-                VALUES (?, ?, CURRENT_TIMESTAMP)
-            """, (rowid, json.dumps(metadata)))
+            size = int(headers.get("content-length", 0))
+        except ValueError:
+            return None
+        return size if size >= RANGE_DOWNLOAD_THRESHOLD else None
+
+    def download_video_ranges(self, download_url, fd, size):
+        """Download a file into fd as parallel Range requests; return False to fall back to one stream"""
+        part_size = -(-size // RANGE_DOWNLOAD_PARTS)
+        ranges = [(start, min(start + part_size, size) - 1) for start in range(0, size, part_size)]
+        
+        try:
+            if hasattr(os, "posix_fallocate"):
+                os.posix_fallocate(fd, 0, size)
             
-            conn.commit()
-            conn.close()
+            with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+                futures = [executor.submit(self.download_range, download_url, fd, start, end)
+                           for start, end in ranges]
+                return all(future.result() for future in futures)
+        
+        except Exception as e:
+            logger.warning(f"Range download failed, falling back to a single stream: {e}")
+            return False
+
+    def download_range(self, download_url, fd, start, end):
+        """Write bytes start..end of download_url into fd at the same offset"""
+        headers = {"Range": f"bytes={start}-{end}"}
+        with self.session.get(download_url, headers=headers, stream=True, timeout=300) as response:
+            response.raise_for_status()
             
-            logger.info(f"Metadata saved for rowid {rowid}")
+            # A 200 means the server ignored the Range header and sent the whole file
+            if response.status_code != 206:
+                return False
             
-        except Exception as e:
-            logger.error(f"Failed to save metadata for rowid {rowid}: {e}")
+            offset = start
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                view = memoryview(chunk)
+                while view:
+                    written = os.pwrite(fd, view, offset)
+                    offset += written
+                    view = view[written:]
+        
+        return offset == end + 1
+
+    def save_processing_metadata(self, rowid, metadata):
+        """Save processing metadata to database"""
+        save_metadata_to_db(rowid, json.dumps(metadata))
 
     def get_apify_download_urls(self, rowid):
         """Get download URLs from Apify for a processed video"""
         try:
-            conn = sqlite3.connect(DB_FILE_PATH, check_same_thread=False)
-            cur = conn.cursor()
+            download_url, dataset_id = get_metadata_download_url(rowid)
             
-            cur.execute("SELECT metadata_json FROM processing_metadata WHERE backup_rowid = ?", (rowid,))
-            result = cur.fetchone()
-            conn.close()
+            if download_url:
+                return download_url
             
-            if result:
-                metadata = json.loads(result[0])
-                dataset_id = metadata.get("dataset_id")
+            # Metadata saved before the download URL was stored only has the dataset id
+            if dataset_id:
+                # Get fresh data from Apify
+                video_data, _ = self.get_first_dataset_item(dataset_id)
                 
-                if dataset_id:
-                    # Get fresh data from Apify
-                    results = []
-                    for item in self.client.dataset(dataset_id).iterate_items():
-                        results.append(item)
-                    
-                    if results:
-                        video_data = results[0]
-                        download_url = (video_data.get("downloadURL") or 
-                                      video_data.get("downloadUrl") or 
-                                      video_data.get("url"))
-                        return download_url
+                if video_data:
+                    return extract_download_url(video_data)
             
             return None
             
@@ -240,12 +348,31 @@ if __name__ == '__main__':
 
 # ------------------- Main -------------------
 
+# Number of videos processed at the same time; each one mostly waits on Apify
+MAX_CONCURRENT_VIDEOS = 4
+
+def process_video(downloader, url, rowid):
+    """Process a single pending video and log the outcome"""
+    logger.info(f"Processing video {rowid}: {url}")
+    
+    metadata = downloader.process_instagram_video(url, rowid)
+    
+    if metadata:
+        logger.info(f"Video {rowid} processed - Run ID: {metadata.get('run_id')}")
+        if metadata.get('local_file'):
+            logger.info(f"Local file: {metadata['local_file']}")
+        else:
+            logger.info("Video available in Apify panel")
+    else:
+        logger.warning(f"Failed to process video {rowid}")
+
 def main():
     apify_token = os.getenv("APIFY_API_TOKEN")
     if not apify_token:
         logger.error("Missing APIFY_API_TOKEN in environment variables")
         return
 
+    init_db()
     downloader = InstagramDownloader(apify_token)
 
     # Get URLs to process
@@ -256,22 +383,10 @@ def main():
 
     logger.info(f"Processing {len(urls)} videos...")
 
-    for url, rowid in urls:
-        logger.info(f"Processing video {rowid}: {url}")
-        
-        metadata = downloader.process_instagram_video(url, rowid)
-        
-        if metadata:
-            logger.info(f"Video {rowid} processed - Run ID: {metadata.get('run_id')}")
-            if metadata.get('local_file'):
-                logger.info(f"Local file: {metadata['local_file']}")
-            else:
-                logger.info("Video available in Apify panel")
-        else:
-            logger.warning(f"Failed to process video {rowid}")
-        
-        # Rate limiting
-        time.sleep(8)
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_VIDEOS) as executor:
+        futures = [executor.submit(process_video, downloader, url, rowid) for url, rowid in urls]
+        for future in as_completed(futures):
+            future.result()
 
     logger.info("Processing complete. Check Apify panel for downloaded videos.")
 
@@ -1,10 +1,12 @@
+import asyncio
 import logging
 import os
 import re
+from collections import deque
 from dotenv import load_dotenv
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from database import init_db, save_data_to_db
+from database import init_db, save_many
 from time import gmtime, strftime
 from module_openai_timestamp import calculate_timestamp
 
@@ -21,57 +23,58 @@ logger = logging.getLogger(__name__)
 # ===========================
 
 # --- Utility Function: Check whether text is a URL --- #
+# Compiled once at import instead of on every incoming message
+URL_PATTERN = re.compile(
+    r'^https?://'  # http:// or https://
+    r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+[A-Z]{2,6}\.?|'  # domain...
+    r'localhost|'  # localhost...
+    r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})'  # ...or ip
+    r'(?::\d+)?'  # optional port
+    r'(?:/?|[/?]\S+)$', re.IGNORECASE)
+
 def is_url(text):
     """Check if text is a URL"""
-    url_pattern = re.compile(
-        r'^https?://'  # http:// or https://
-        r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+[A-Z]{2,6}\.?|'  # domain...
-        r'localhost|'  # localhost...
-        r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})'  # ...or ip
-        r'(?::\d+)?'  # optional port
-        r'(?:/?|[/?]\S+)$', re.IGNORECASE)
-    return url_pattern.match(text) is not None
+    return URL_PATTERN.match(text) is not None
 # ===========================
 
 # --- Utility Function: Parse date and category from text like 'date, category1/category2/..., description(optional)' --- #
 def parse_date_categories_description(text):
-    try:
-        parts = text.strip().split(",")
-        if len(parts) == 3:
-            print(parts[0], parts[1], parts[2])
-            return parts[0], parts[1], parts[2]
-        elif len(parts) == 2:
-            return parts[0], parts[1], None
-        return None, None, None
-    except:
-        return None, None, None
+    # Split on the first two commas only, so the description may contain commas itself
+    date, _, rest = text.strip().partition(",")
+    categories, _, description = rest.partition(",")
+    return date.strip() or None, categories.strip() or None, description.strip() or None
 # ===========================
 
 
 class DataCollector:
     def __init__(self):
+        # Only touched from handlers on the event loop thread, never from worker threads
         self.user_messages = {}
     
     def add_message(self, user_id, username, message):
+        """Queue a message; return the next (first, second) pair once two are pending, else None"""
         if user_id not in self.user_messages:
             self.user_messages[user_id] = {
-                'messages': [],
+                'messages': deque(),
                 'username': username
             }
 
-        self.user_messages[user_id]['username'] = username
-        self.user_messages[user_id]['messages'].append(message)
-
-        if len(self.user_messages[user_id]['messages']) >= 2:
-            return self.process_messages(user_id)
-        
-        return None
-    
-    def process_messages(self, user_id):
         user_data = self.user_messages[user_id]
-        messages = user_data['messages'][:2]
-        username = user_data['username']
+        user_data['username'] = username
+        user_data['messages'].append(message)
+
+        if len(user_data['messages']) < 2:
+            return None
+
+        messages = [user_data['messages'].popleft(), user_data['messages'].popleft()]
+
+        # Forget users with nothing pending so finished sessions don't pile up
+        if not user_data['messages']:
+            del self.user_messages[user_id]
 
+        return messages
+    
+    def process_messages(self, user_id, username, messages):
         url = None
         date = None
         categories = None
@@ -84,7 +87,7 @@ class DataCollector:
                 url = msg
             else:
                 parsed_date, parsed_categories, parsed_description = parse_date_categories_description(msg)
-                time_now = strftime("%Y-%m-%d %H:%M:%S", gmtime())
+                time_now = strftime("%Y-%m-%d %H:%M:00", gmtime()) # Minute granularity so repeated dates hit the timestamp cache
                 if parsed_date and parsed_categories and parsed_description:
                     date = calculate_timestamp(parsed_date, time_now) # To return date in the YYYY, MM, DD HH:MM:SS format
                     categories = parsed_categories
@@ -94,16 +97,13 @@ class DataCollector:
                     categories = parsed_categories
                     description = "No description has been provided"
 
-        # Remove processed messages
-        self.user_messages[user_id]['messages'] = self.user_messages[user_id]['messages'][2:]
-
         # Validate we have all required data
         if url and date and categories and description:
             try:
-                # Prepare data for storing in database
-                categories_list = categories.strip().split("/")
-                for category in categories_list:
-                    data = {
+                # Prepare data for storing in database: one row per distinct, non-empty category
+                categories_list = dict.fromkeys(c.strip() for c in categories.split("/"))
+                rows = [
+                    {
                         'telegram_id': user_id,
                         'username': username,
                         'category': category,
@@ -112,9 +112,16 @@ class DataCollector:
                         'date': date,
                         'upload_status': upload_status
                     }
+                    for category in categories_list if category
+                ]
+                if not rows:
+                    return {
+                        "success": False,
+                        "error": "No valid category provided."
+                    }
                 
-                    # Save to database
-                    save_data_to_db(data)
+                # Save every category in one transaction
+                save_many(rows)
 
                 return {
                     "success": True,
@@ -137,8 +144,7 @@ class DataCollector:
 
     def clear_user_messages(self, user_id):
         """Clear all pending messages for a user"""
-        if user_id in self.user_messages:
-            self.user_messages[user_id]["messages"] = []
+        self.user_messages.pop(user_id, None)
 
 # Creating a global data collector instance
 data_collector = DataCollector()
@@ -175,12 +181,20 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     logger.info(f"Received message from user {user.id} ({user.username}): {message_text}") 
 
-    result = data_collector.add_message(user.id, user.username or user.first_name, message_text) # Adding message to collector
+    username = user.username or user.first_name
+
+    # Adding message to collector before any await, so messages are paired in the order they arrived
+    messages = data_collector.add_message(user.id, username, message_text)
 
-    if result is None:
+    if messages is None:
         # Still awaiting the second message
         await update.message.reply_text("Got it! 📝 Send me the second message.")
-    elif result["success"]:
+        return
+
+    # Processing blocks on OpenAI and SQLite, so keep it off the event loop
+    result = await asyncio.to_thread(data_collector.process_messages, user.id, username, messages)
+
+    if result["success"]:
         # Successfully processed
         await update.message.reply_text( 
             f"✅ Data saved successfully!\n\n"
@@ -235,7 +249,7 @@ def main():
         return
 
     # Create application
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    application = Application.builder().token(TELEGRAM_BOT_TOKEN).concurrent_updates(True).build()
     
     # Add handlers
     application.add_handler(CommandHandler("start", start))
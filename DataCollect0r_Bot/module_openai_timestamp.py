@@ -1,4 +1,5 @@
 import os
+from functools import lru_cache
 from dotenv import load_dotenv
 from openai import OpenAI
 
@@ -11,6 +12,8 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 client = OpenAI(api_key=OPENAI_API_KEY)
 # =============================== 
 
+# Identical (date, time_now) pairs always resolve to the same datetime
+@lru_cache(maxsize=4096)
 def calculate_timestamp(date, time_now):
     response = client.responses.create(
         model="gpt-4.1-mini",
@@ -1,47 +1,186 @@
 import os
+import logging
+import random
+import threading
+import time
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from dotenv import load_dotenv
-from database import get_payload_data, change_upload_status
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+from openai import OpenAIError
+from database import get_payload_data, change_upload_status_many
 from module_openai_categorizer import categorize
 
+try:
+    # orjson is optional; it serializes large batches several times faster than json
+    from orjson import dumps as json_dumps
+except ImportError:
+    from json import dumps as _dumps
+
+    def json_dumps(obj):
+        return _dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
 # Load environment variables and API_URL
 load_dotenv()
 API_URL = os.getenv("API_URL")
 # ===========================
 
 HEADERS = {"Content-Type": "application/json"}
-CORRECT_CATEGORIES = ["general", "clothing", "medical",
-                      "restaurant", "AI", "fun",
-                      "beauty", "medical", "education", "inspirational", "other"
-                      ]
-
-rows = get_payload_data()
-
-for row in rows:
-    rowid, telegram_id, username, url, category, date, upload_status, description= row
-    categorized_value = categorize(category)
-    while categorized_value not in CORRECT_CATEGORIES:
-        categorized_value = categorize(category) 
-    
-    payload = [
-        {
-        "post_url": url,
-        "date": date,
-        "category": categorized_value,
-        "description": description
-    }
-    ]
 
+# Shared session so every POST reuses one pooled keep-alive connection
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+_adapter = HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=32,
+    # urllib3 does not retry POST by default. Only connect failures and 429/503 are retried: they
+    # mean the batch was not processed. A 500/502/504 or a read error (timeout, dropped connection)
+    # may come after the server already stored the rows, so those are never re-sent.
+    max_retries=Retry(
+        total=5,
+        read=0,
+        backoff_factor=0.5,
+        status_forcelist=[429, 503],
+        allowed_methods=frozenset(["POST"]),
+        respect_retry_after_header=True
+    )
+)
+SESSION.mount("http://", _adapter)
+SESSION.mount("https://", _adapter)
+
+# (connect, read) timeout for each upload POST, so a stalled connection can't hold a worker forever
+UPLOAD_TIMEOUT = (10, 60)
+
+# The API accepts a JSON array, so rows are sent this many per POST
+BATCH_SIZE = 500
+
+# Number of batches in flight at the same time
+MAX_UPLOAD_WORKERS = 8
+
+# Number of OpenAI categorize requests in flight at the same time
+MAX_CATEGORIZE_WORKERS = 16
+
+# Chunks read from the database but not yet uploaded; bounds memory while stages overlap
+MAX_PENDING_BATCHES = 2 * MAX_UPLOAD_WORKERS
+
+CORRECT_CATEGORIES = frozenset({"general", "clothing", "medical",
+                                "restaurant", "AI", "fun",
+                                "beauty", "meditation", "education", "inspirational", "other"
+                                })
+
+# Attempts at getting a valid category before falling back to "other"
+CATEGORIZE_ATTEMPTS = 5
+
+def categorize_validated(category):
+    """Map a raw category onto one of CORRECT_CATEGORIES"""
+    # Already a valid category, no need to ask OpenAI
+    if category.strip() in CORRECT_CATEGORIES:
+        return category.strip()
+
+    last_error = None
+    for attempt in range(CATEGORIZE_ATTEMPTS):
+        # An API error is retried like an answer outside the list
+        try:
+            categorized_value = categorize(category)
+            if categorized_value in CORRECT_CATEGORIES:
+                return categorized_value
+        except (OpenAIError, requests.RequestException) as e:
+            logger.warning(f"Categorize attempt {attempt + 1} for {category!r} failed: {e}")
+            last_error = e
+
+        if attempt < CATEGORIZE_ATTEMPTS - 1:
+            # Exponential backoff with jitter so parallel workers don't retry in lockstep
+            time.sleep(min(2 ** attempt, 10) + random.random())
+
+    # Don't relabel rows as "other" because of an outage or a bad key; raising leaves
+    # them pending in dataset for the next run
+    if last_error is not None:
+        raise last_error
+
+    logger.warning(f"No valid category for {category!r} after {CATEGORIZE_ATTEMPTS} attempts, using 'other'")
+    return "other"
+
+def send_batch(batch, batch_meta):
+    """POST one batch of payload items and mark its rows as uploaded on success"""
     try:
-        response = requests.post(API_URL, json=payload, headers=HEADERS)
+        # Serialized once here; the session already sends the JSON Content-Type header
+        response = SESSION.post(API_URL, data=json_dumps(batch), timeout=UPLOAD_TIMEOUT)
         if response.status_code == 200:
-            print("✅ Sent:", payload)
-            print(description)
-            change_upload_status(rowid, telegram_id, username,
-                                 url, categorized_value, date, 
-                                 description, upload_status
-                                 )
+            logger.info(f"Sent {len(batch)} rows")
+            change_upload_status_many(batch_meta)
         else:
-            print(f"❌ Failed for {url}: {response.status_code} - {response.text}")
+            logger.error(f"Failed for batch of {len(batch)} rows: {response.status_code} - {response.text}")
+    except Exception as e:
+        logger.error(f"Error sending batch of {len(batch)} rows: {e}")
+
+def upload_chunk(chunk, categorized, pending):
+    """Build the payload for one chunk of rows once its categories are ready, then send it"""
+    try:
+        batch = []
+        batch_meta = [] # (rowid, category) pairs for change_upload_status_many
+        failed = set()
+
+        for row in chunk:
+            # Rows whose category could not be resolved stay pending for the next run
+            try:
+                categorized_value = categorized[row.category].result()
+            except Exception as e:
+                if row.category not in failed:
+                    failed.add(row.category)
+                    logger.error(f"Skipping rows with category {row.category!r}: {e}")
+                continue
+
+            batch.append({
+                "post_url": row.url,
+                "date": row.date,
+                "category": categorized_value,
+                "description": row.description
+            })
+            batch_meta.append((row.rowid, categorized_value))
+
+        if batch:
+            send_batch(batch, batch_meta)
     except Exception as e:
-        print(f"❌ Error sending {url}:", e)
\ No newline at end of file
+        logger.error(f"Failed to prepare batch of {len(chunk)} rows: {e}")
+    finally:
+        pending.release()
+
+def main():
+    """Categorize every pending row and send it to API_URL"""
+    rows = get_payload_data(BATCH_SIZE)
+
+    # Raw category -> Future, shared across chunks so each one is only sent to OpenAI once
+    category_futures = {}
+    pending = threading.BoundedSemaphore(MAX_PENDING_BATCHES)
+
+    # Reading, categorizing and uploading overlap: the loop keeps reading chunks and queueing
+    # their categories while earlier chunks wait on OpenAI or are being POSTed. Leaving the
+    # with-block waits for every pending batch.
+    with ThreadPoolExecutor(max_workers=MAX_CATEGORIZE_WORKERS) as categorizer, \
+         ThreadPoolExecutor(max_workers=MAX_UPLOAD_WORKERS) as uploader:
+        while True:
+            pending.acquire()
+            chunk = list(islice(rows, BATCH_SIZE))
+            if not chunk:
+                pending.release()
+                break
+
+            categorized = {}
+            for row in chunk:
+                future = category_futures.get(row.category)
+                # Resubmit a category whose earlier attempt failed instead of failing every later chunk
+                if future is None or (future.done() and future.exception() is not None):
+                    future = category_futures[row.category] = categorizer.submit(categorize_validated, row.category)
+                categorized[row.category] = future
+
+            uploader.submit(upload_chunk, chunk, categorized, pending)
+
+if __name__ == "__main__":
+    with SESSION:
+        main()